@@ -12,26 +12,83 @@ Author: Abdoulaye Diop
 Date: 12 May 2024
 """
 
+import os
+import tempfile
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    from pyarrow import csv as pacsv
 
-DATA_DIR = Path("data")
-
+    # Arrow reader parses with multiple threads and keeps untyped columns Arrow backed
+    CSV_READ_OPTIONS = {"engine": "pyarrow", "dtype_backend": "pyarrow"}
+except ImportError:
+    pa = None
+    CSV_READ_OPTIONS = {}
 
-def load_business_data(path: Path) -> pd.DataFrame:
-    df = pd.read_csv(path)
 
-    if "Year" not in df.columns:
-        raise ValueError("Business data must contain a Year column")
+DATA_DIR = Path("data")
 
-    df = df.dropna(subset=["Year"]).copy()
-    df["Year"] = df["Year"].astype(int)
-    df = df.set_index("Year").sort_index()
+# Integer columns are nullable so blank rows still parse and are dropped on Year afterwards
+BUSINESS_DTYPES = {
+    "Year": "Int32",
+    "Forecasted Demand": "Int64",
+    "Operational Cost (USD)": "float64",
+    "Required Labor Hours": "float64",
+    "Required Machinery Hours": "float64",
+    "Average Wage (USD)": "float64",
+    "Workforce Size": "Int64",
+    "Labor Market Tightness": "float64",
+    "Expected Total Revenue (USD)": "float64",
+    "Expected Raw Material Cost (USD)": "float64",
+    "Expected Compliance Cost (USD)": "float64",
+    "Expected Environmental Compliance Cost (USD)": "float64",
+    "Expected Labor Law Changes Impact Cost (USD)": "float64",
+    "Expected Technology Investment Cost (USD)": "float64",
+    "Annual Budget (USD)": "float64",
+}
+
+
+def read_business_csv(path: Path) -> pd.DataFrame:
+    # Callable usecols tolerates absent columns so the caller's own checks report them
+    return pd.read_csv(path, usecols=lambda c: c in BUSINESS_DTYPES, dtype=BUSINESS_DTYPES)
+
+
+def read_business_table(path: Path) -> "pa.Table":
+    cache_path = path.with_suffix(".parquet")
+    if cache_path.exists() and os.path.getmtime(cache_path) > os.path.getmtime(path):
+        try:
+            return pq.read_table(cache_path)
+        except (OSError, pa.ArrowInvalid):
+            # Unreadable mirror, parse the CSV again and overwrite it below
+            pass
+
+    # Everything is parsed as float64, Arrow rejects values like 2014.0 in integer columns where
+    # pandas accepts them, so integer columns are cast once blank rows are dropped
+    column_types = {col: pa.float64() for col in BUSINESS_DTYPES}
+    table = pacsv.read_csv(path, convert_options=pacsv.ConvertOptions(column_types=column_types))
+
+    # Write beside the target and move it into place so a partial mirror is never picked up
+    try:
+        fd, tmp_name = tempfile.mkstemp(dir=cache_path.parent, suffix=".parquet.tmp")
+        os.close(fd)
+        try:
+            pq.write_table(table, tmp_name)
+            os.replace(tmp_name, cache_path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+    except OSError:
+        pass
+
+    return table
 
-    if df.index.has_duplicates:
-        raise ValueError("Business data contains duplicate years")
 
+def load_business_data(path: Path) -> pd.DataFrame:
     required_cols = [
         "Forecasted Demand",
         "Operational Cost (USD)",
@@ -49,6 +106,47 @@ def load_business_data(path: Path) -> pd.DataFrame:
         "Annual Budget (USD)",
     ]
 
+    if pa is not None:
+        # Parse, type and validate on the Arrow table, converting to pandas once at the end
+        table = read_business_table(path)
+
+        if "Year" not in table.schema.names:
+            raise ValueError("Business data must contain a Year column")
+
+        missing = [c for c in required_cols if c not in table.schema.names]
+        if missing:
+            raise ValueError(f"Business data missing columns: {missing}")
+
+        table = table.select(["Year"] + required_cols)
+        table = table.filter(pc.is_valid(table["Year"]))
+
+        for col, dtype in BUSINESS_DTYPES.items():
+            if dtype.startswith("Int"):
+                try:
+                    values = pc.cast(table[col], pa.from_numpy_dtype(np.dtype(dtype.lower())))
+                except pa.ArrowInvalid as exc:
+                    raise ValueError(f"Business data column {col} must hold whole numbers") from exc
+                table = table.set_column(table.schema.get_field_index(col), col, values)
+
+        if pc.count_distinct(table["Year"]).as_py() != table.num_rows:
+            raise ValueError("Business data contains duplicate years")
+
+        df = table.sort_by("Year").to_pandas(self_destruct=True)
+        return df.set_index("Year")
+
+    # Without pyarrow there is no Parquet mirror, read_business_table is its only reader and writer
+    df = read_business_csv(path)
+
+    if "Year" not in df.columns:
+        raise ValueError("Business data must contain a Year column")
+
+    df = df.dropna(subset=["Year"]).copy()
+    df["Year"] = df["Year"].astype("int32")
+    df = df.set_index("Year").sort_index()
+
+    if df.index.has_duplicates:
+        raise ValueError("Business data contains duplicate years")
+
     missing = [c for c in required_cols if c not in df.columns]
     if missing:
         raise ValueError(f"Business data missing columns: {missing}")
@@ -57,7 +155,7 @@ def load_business_data(path: Path) -> pd.DataFrame:
 
 
 def load_expansion_costs(path: Path) -> pd.DataFrame:
-    df = pd.read_csv(path)
+    df = pd.read_csv(path, **CSV_READ_OPTIONS)
 
     if "Proposed Expansion" not in df.columns:
         raise ValueError("Expansion costs must contain a Proposed Expansion column")
@@ -17,9 +17,72 @@ Date: 12 May 2024
 
 from __future__ import annotations
 
-from typing import Dict, Tuple
+from typing import Callable, Dict, List, Tuple
+import numpy as np
 import pandas as pd
 import pyomo.environ as pyo
+from pyomo.core.expr.numeric_expr import LinearExpression
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# For target year i, entries offsets[i]:offsets[i + 1] of start_pos and exp_pos list the
+# (start year, expansion) positions whose capacity is online by that year, same layout as
+# build_prefix_numpy below
+def build_prefix_loops(yr: np.ndarray, bt_vec: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    n_years = yr.size
+    n_exp = bt_vec.size
+
+    offsets = np.zeros(n_years + 1, dtype=np.int64)
+    start_pos = np.empty(n_years * n_years * n_exp, dtype=np.int64)
+    exp_pos = np.empty(n_years * n_years * n_exp, dtype=np.int64)
+    pos = 0
+    for i in range(n_years):
+        for j in range(n_years):
+            for k in range(n_exp):
+                if yr[i] >= yr[j] + bt_vec[k]:
+                    start_pos[pos] = j
+                    exp_pos[pos] = k
+                    pos += 1
+        offsets[i + 1] = pos
+
+    return offsets, start_pos[:pos], exp_pos[:pos]
+
+
+def build_prefix_numpy(yr: np.ndarray, bt_vec: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # eligible[i, j, k]: expansion k started in year j is online by year i
+    eligible = yr[:, None, None] >= yr[None, :, None] + bt_vec[None, None, :]
+    target, start_pos, exp_pos = np.nonzero(eligible)
+
+    offsets = np.zeros(yr.size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(target, minlength=yr.size))
+
+    return offsets, start_pos, exp_pos
+
+
+# The loop version only pays off compiled, without numba the broadcast mask is faster
+build_prefix = njit(cache=True)(build_prefix_loops) if njit is not None else build_prefix_numpy
+
+
+def annual_fixed_cost(m: pyo.ConcreteModel, y: int) -> pyo.Expression:
+    # Non expansion cost of one year, the single definition shared by budget rows, objective and report
+    return (
+        m.operational_cost[y]
+        + m.req_labor_hours[y] * m.avg_wage[y]
+        + m.req_machine_hours[y] * m.avg_wage[y]
+        + m.raw_material_cost[y]
+        + m.compliance_cost[y]
+        + m.env_compliance_cost[y]
+        + m.labor_law_cost[y]
+        + m.tech_invest_cost[y]
+    )
+
+
+def fixed_cost_total(m: pyo.ConcreteModel) -> float:
+    return float(sum(pyo.value(annual_fixed_cost(m, y)) for y in m.Years))
 
 
 def build_model(
@@ -35,83 +98,120 @@ def build_model(
     m.Years = pyo.Set(initialize=years, ordered=True)
     m.Expansions = pyo.Set(initialize=exp_names, ordered=False)
 
-    m.Select = pyo.Var(m.Years, m.Expansions, within=pyo.Binary)
+    # Build times are read once as whole years, no rule evaluates the time_to_build Param
+    bt_vec = expansions["Time to Build (year)"].to_numpy(dtype=np.float64).astype(np.int64)
+    bt = dict(zip(exp_names, bt_vec.tolist()))
+
+    # Only starts that come online within the horizon can contribute capacity
+    feasible = [(y, e) for e in exp_names for y in years if y + bt[e] <= years[-1]]
+    m.SelectIdx = pyo.Set(initialize=feasible, dimen=2)
+
+    m.Select = pyo.Var(m.SelectIdx, within=pyo.Binary)
+
+    year_idx = {y: i for i, y in enumerate(years)}
+    exp_idx = {e: i for i, e in enumerate(exp_names)}
+
+    # Param rules read from one float64 array per column instead of a materialized dict
+    def year_values(col: str) -> Callable[[pyo.ConcreteModel, int], float]:
+        arr = business[col].to_numpy(dtype=np.float64)
+        return lambda m, y, a=arr: float(a[year_idx[y]])
 
-    m.demand = pyo.Param(m.Years, initialize=business["Forecasted Demand"].to_dict())
-    m.operational_cost = pyo.Param(m.Years, initialize=business["Operational Cost (USD)"].to_dict())
-    m.req_labor_hours = pyo.Param(m.Years, initialize=business["Required Labor Hours"].to_dict())
-    m.req_machine_hours = pyo.Param(m.Years, initialize=business["Required Machinery Hours"].to_dict())
-    m.avg_wage = pyo.Param(m.Years, initialize=business["Average Wage (USD)"].to_dict())
-    m.raw_material_cost = pyo.Param(m.Years, initialize=business["Expected Raw Material Cost (USD)"].to_dict())
-    m.compliance_cost = pyo.Param(m.Years, initialize=business["Expected Compliance Cost (USD)"].to_dict())
-    m.env_compliance_cost = pyo.Param(m.Years, initialize=business["Expected Environmental Compliance Cost (USD)"].to_dict())
-    m.labor_law_cost = pyo.Param(m.Years, initialize=business["Expected Labor Law Changes Impact Cost (USD)"].to_dict())
-    m.tech_invest_cost = pyo.Param(m.Years, initialize=business["Expected Technology Investment Cost (USD)"].to_dict())
-    m.budget = pyo.Param(m.Years, initialize=business["Annual Budget (USD)"].to_dict())
+    def exp_values(col: str) -> Callable[[pyo.ConcreteModel, str], float]:
+        arr = expansions[col].to_numpy(dtype=np.float64)
+        return lambda m, e, a=arr: float(a[exp_idx[e]])
 
-    m.exp_cost = pyo.Param(m.Expansions, initialize=expansions["Cost (USD)"].to_dict())
-    m.time_to_build = pyo.Param(m.Expansions, initialize=expansions["Time to Build (year)"].to_dict())
-    m.add_capacity = pyo.Param(m.Expansions, initialize=expansions["Additional Capacity (units)"].to_dict())
+    m.demand = pyo.Param(m.Years, initialize=year_values("Forecasted Demand"), mutable=True)
+    m.operational_cost = pyo.Param(m.Years, initialize=year_values("Operational Cost (USD)"), mutable=True)
+    m.req_labor_hours = pyo.Param(m.Years, initialize=year_values("Required Labor Hours"), mutable=True)
+    m.req_machine_hours = pyo.Param(m.Years, initialize=year_values("Required Machinery Hours"), mutable=True)
+    m.avg_wage = pyo.Param(m.Years, initialize=year_values("Average Wage (USD)"), mutable=True)
+    m.raw_material_cost = pyo.Param(m.Years, initialize=year_values("Expected Raw Material Cost (USD)"), mutable=True)
+    m.compliance_cost = pyo.Param(m.Years, initialize=year_values("Expected Compliance Cost (USD)"), mutable=True)
+    m.env_compliance_cost = pyo.Param(m.Years, initialize=year_values("Expected Environmental Compliance Cost (USD)"), mutable=True)
+    m.labor_law_cost = pyo.Param(m.Years, initialize=year_values("Expected Labor Law Changes Impact Cost (USD)"), mutable=True)
+    m.tech_invest_cost = pyo.Param(m.Years, initialize=year_values("Expected Technology Investment Cost (USD)"), mutable=True)
+    m.budget = pyo.Param(m.Years, initialize=year_values("Annual Budget (USD)"), mutable=True)
+
+    m.exp_cost = pyo.Param(m.Expansions, initialize=exp_values("Cost (USD)"), mutable=True)
+    m.time_to_build = pyo.Param(m.Expansions, initialize=exp_values("Time to Build (year)"))
+    m.add_capacity = pyo.Param(m.Expansions, initialize=exp_values("Additional Capacity (units)"), mutable=True)
 
     m.initial_capacity = pyo.Param(initialize=int(initial_capacity))
 
+    yr = np.array(years, dtype=np.int64)
+    offsets, start_pos, exp_pos = build_prefix(yr, bt_vec)
+
+    added: Dict[int, List[Tuple[pyo.Param, pyo.Var]]] = {}
+    for i, y in enumerate(years):
+        lo, hi = offsets[i], offsets[i + 1]
+        added[y] = [
+            (m.add_capacity[exp_names[k]], m.Select[years[j], exp_names[k]])
+            for j, k in zip(start_pos[lo:hi].tolist(), exp_pos[lo:hi].tolist())
+        ]
+
+    labor_y = business["Required Labor Hours"] * business["Average Wage (USD)"]
+    machine_y = business["Required Machinery Hours"] * business["Average Wage (USD)"]
+    other_y = business[
+        [
+            "Operational Cost (USD)",
+            "Expected Raw Material Cost (USD)",
+            "Expected Compliance Cost (USD)",
+            "Expected Environmental Compliance Cost (USD)",
+            "Expected Labor Law Changes Impact Cost (USD)",
+            "Expected Technology Investment Cost (USD)",
+        ]
+    ].sum(axis=1)
+
+    over_budget = business.index[labor_y + machine_y + other_y > business["Annual Budget (USD)"]]
+    if len(over_budget) > 0:
+        raise ValueError(f"Annual costs exceed budget before any expansion in years: {list(over_budget)}")
+
+    # Non expansion costs carry no decision variables, so they enter the objective through one
+    # mutable Param. solve_model refreshes it from the cost Params before every solve.
+    m.fixed_cost = pyo.Param(initialize=fixed_cost_total(m), mutable=True)
+
     def total_cost_rule(m: pyo.ConcreteModel) -> pyo.Expression:
-        expansion_spend = sum(m.exp_cost[e] * m.Select[y, e] for y in m.Years for e in m.Expansions)
-
-        labor_cost = sum(m.req_labor_hours[y] * m.avg_wage[y] for y in m.Years)
-        machine_cost = sum(m.req_machine_hours[y] * m.avg_wage[y] for y in m.Years)
-
-        other_annual = sum(
-            m.operational_cost[y]
-            + m.raw_material_cost[y]
-            + m.compliance_cost[y]
-            + m.env_compliance_cost[y]
-            + m.labor_law_cost[y]
-            + m.tech_invest_cost[y]
-            for y in m.Years
+        expansion_spend = LinearExpression(
+            constant=0.0,
+            linear_coefs=[m.exp_cost[e] for _, e in feasible],
+            linear_vars=[m.Select[y, e] for y, e in feasible],
         )
 
-        return expansion_spend + labor_cost + machine_cost + other_annual
+        return expansion_spend + m.fixed_cost
 
     m.TotalCost = pyo.Objective(rule=total_cost_rule, sense=pyo.minimize)
 
     def one_time_expansion_rule(m: pyo.ConcreteModel, e: str) -> pyo.Constraint:
-        return sum(m.Select[y, e] for y in m.Years) <= 1
+        starts = [m.Select[y, e] for y in m.Years if (y, e) in m.SelectIdx]
+        if not starts:
+            return pyo.Constraint.Skip
+        return pyo.quicksum(starts) <= 1
 
     m.OneTimeExpansion = pyo.Constraint(m.Expansions, rule=one_time_expansion_rule)
 
-    def capacity_available(m: pyo.ConcreteModel, y: int) -> pyo.Expression:
-        added = 0
-        for e in m.Expansions:
-            build_time = int(pyo.value(m.time_to_build[e]))
-            for y0 in m.Years:
-                if int(y0) + build_time <= int(y):
-                    added += m.add_capacity[e] * m.Select[y0, e]
-        return m.initial_capacity + added
-
     def demand_satisfaction_rule(m: pyo.ConcreteModel, y: int) -> pyo.Constraint:
-        return capacity_available(m, y) >= m.demand[y]
+        capacity_y = LinearExpression(
+            constant=m.initial_capacity,
+            linear_coefs=[c for c, _ in added[y]],
+            linear_vars=[v for _, v in added[y]],
+        )
+        return capacity_y >= m.demand[y]
+
+    # Years already covered by initial capacity need no demand row
+    binding_years = [y for y in years if int(business.loc[y, "Forecasted Demand"]) > int(initial_capacity)]
+    m.BindingYears = pyo.Set(initialize=binding_years, ordered=True)
 
-    m.DemandSatisfaction = pyo.Constraint(m.Years, rule=demand_satisfaction_rule)
+    m.DemandSatisfaction = pyo.Constraint(m.BindingYears, rule=demand_satisfaction_rule)
 
     def annual_budget_rule(m: pyo.ConcreteModel, y: int) -> pyo.Constraint:
-        expansion_spend_y = sum(m.exp_cost[e] * m.Select[y, e] for e in m.Expansions)
-
-        labor_cost_y = m.req_labor_hours[y] * m.avg_wage[y]
-        machine_cost_y = m.req_machine_hours[y] * m.avg_wage[y]
-
-        total_y = (
-            expansion_spend_y
-            + m.operational_cost[y]
-            + labor_cost_y
-            + machine_cost_y
-            + m.raw_material_cost[y]
-            + m.compliance_cost[y]
-            + m.env_compliance_cost[y]
-            + m.labor_law_cost[y]
-            + m.tech_invest_cost[y]
+        expansion_spend_y = LinearExpression(
+            constant=0.0,
+            linear_coefs=[m.exp_cost[e] for e in exp_names if (y, e) in m.SelectIdx],
+            linear_vars=[m.Select[y, e] for e in exp_names if (y, e) in m.SelectIdx],
         )
 
+        total_y = expansion_spend_y + annual_fixed_cost(m, y)
+
         return total_y <= m.budget[y]
 
     m.BudgetLimit = pyo.Constraint(m.Years, rule=annual_budget_rule)
@@ -12,122 +12,222 @@ Author: Abdoulaye Diop
 Date: 12 May 2024
 """
 
+import hashlib
+import os
+import pickle
+import tempfile
 from pathlib import Path
+from typing import Any, Dict
+import numpy as np
 import pandas as pd
 import pyomo.environ as pyo
+from pyomo.version import version as pyomo_version
 
-from src_02_optimization_model import build_model
+try:
+    from pyomo.contrib.appsi.solvers.highs import Highs
+except ImportError:
+    Highs = None
+
+try:
+    import cloudpickle
+except ImportError:
+    cloudpickle = None
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+except ImportError:
+    pa = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+from src_01_data_preparation import load_business_data, load_expansion_costs
+from src_02_optimization_model import annual_fixed_cost, build_model, fixed_cost_total
 
 
 DATA_DIR = Path("data")
 RESULTS_DIR = Path("results")
+MODEL_CACHE_DIR = Path(".cache")
 
 
 def load_inputs() -> tuple[pd.DataFrame, pd.DataFrame]:
-    business = pd.read_csv(DATA_DIR / "Business_Planning_Data_2014_2024.csv")
-    business["Year"] = business["Year"].astype(int)
-    business = business.set_index("Year").sort_index()
-
-    expansions = pd.read_csv(DATA_DIR / "Expansion_Costs.csv")
-    expansions = expansions.set_index("Proposed Expansion").sort_index()
+    business = load_business_data(DATA_DIR / "Business_Planning_Data_2014_2024.csv")
+    expansions = load_expansion_costs(DATA_DIR / "Expansion_Costs.csv")
 
     return business, expansions
 
 
-def solve_model(model: pyo.ConcreteModel) -> pyo.SolverResults:
+def make_solver() -> Any:
+    if Highs is not None:
+        solver = Highs()
+        if solver.available():
+            solver.config.stream_solver = True
+            # Solutions are loaded by solve_model only after the termination check passes
+            solver.config.load_solution = False
+            solver.highs_options["threads"] = os.cpu_count() or 1
+            return solver
+
     solver = pyo.SolverFactory("glpk")
 
     if solver is None or not solver.available():
         raise RuntimeError(
-            "GLPK not available. Install glpk and ensure glpsol is on your system PATH."
+            "No solver available. Install highspy for HiGHS, or install glpk and ensure glpsol is on your system PATH."
         )
 
-    results = solver.solve(model, tee=True)
+    return solver
+
+
+def solve_model(model: pyo.ConcreteModel, solver: Any = None, warmstart: bool = False) -> Any:
+    if solver is None:
+        solver = make_solver()
+
+    # The objective's fixed cost term is a cached total, bring it in line with the cost Params
+    model.fixed_cost = fixed_cost_total(model)
+
+    is_appsi = Highs is not None and isinstance(solver, Highs)
+
+    if is_appsi:
+        # Persistent interface, re solving the same model only pushes what changed
+        results = solver.solve(model)
+        term = results.termination_condition.name
+    else:
+        # Current variable values seed the next solve when the solver plugin can use them
+        solve_kwargs = {}
+        if warmstart and solver.warm_start_capable():
+            solve_kwargs["warmstart"] = True
+
+        results = solver.solve(model, tee=True, **solve_kwargs)
+        term = str(results.solver.termination_condition)
 
-    term = str(results.solver.termination_condition)
     if term.lower() not in {"optimal", "locallyoptimal"}:
         raise RuntimeError(f"Solver did not reach an optimal solution. Termination: {term}")
 
+    if is_appsi:
+        results.solution_loader.load_vars()
+
     return results
 
 
-def export_results(model: pyo.ConcreteModel, business: pd.DataFrame) -> None:
-    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+def write_csv(df: pd.DataFrame, path: Path) -> None:
+    if pa is None:
+        df.to_csv(path, index=False)
+        return
 
-    plan_rows = []
-    cost_rows = []
-
-    for y in sorted(list(model.Years)):
-        selected = []
-        expansion_spend_y = 0.0
-
-        for e in model.Expansions:
-            if pyo.value(model.Select[y, e]) > 0.5:
-                cost_e = float(pyo.value(model.exp_cost[e]))
-                expansion_spend_y += cost_e
-                selected.append(str(e))
-
-        labor_cost_y = float(pyo.value(model.req_labor_hours[y] * model.avg_wage[y]))
-        machine_cost_y = float(pyo.value(model.req_machine_hours[y] * model.avg_wage[y]))
-
-        operational = float(pyo.value(model.operational_cost[y]))
-        raw_mat = float(pyo.value(model.raw_material_cost[y]))
-        compliance = float(pyo.value(model.compliance_cost[y]))
-        env = float(pyo.value(model.env_compliance_cost[y]))
-        labor_law = float(pyo.value(model.labor_law_cost[y]))
-        tech = float(pyo.value(model.tech_invest_cost[y]))
-
-        total_y = (
-            expansion_spend_y
-            + operational
-            + labor_cost_y
-            + machine_cost_y
-            + raw_mat
-            + compliance
-            + env
-            + labor_law
-            + tech
-        )
+    pacsv.write_csv(
+        pa.Table.from_pandas(df, preserve_index=False),
+        path,
+        write_options=pacsv.WriteOptions(quoting_style="needed"),
+    )
 
-        budget_y = float(pyo.value(model.budget[y]))
-        savings_y = budget_y - total_y
-
-        plan_rows.append(
-            {
-                "Year": int(y),
-                "Selected_Expansions": ", ".join(selected) if selected else "None",
-                "Annual_Budget": budget_y,
-                "Annual_Total_Cost": total_y,
-                "Annual_Budget_Savings": savings_y,
-            }
-        )
 
-        cost_rows.append(
-            {
-                "Year": int(y),
-                "Expansion_Spend": expansion_spend_y,
-                "Operational_Cost": operational,
-                "Labor_Cost": labor_cost_y,
-                "Machinery_Cost": machine_cost_y,
-                "Raw_Material_Cost": raw_mat,
-                "Compliance_Cost": compliance,
-                "Environmental_Compliance_Cost": env,
-                "Labor_Law_Impact_Cost": labor_law,
-                "Technology_Investment_Cost": tech,
-                "Total_Cost": total_y,
-            }
-        )
+def compute_breakdown(
+    sel: np.ndarray,
+    exp_cost: np.ndarray,
+    fixed: np.ndarray,
+    budget: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    n_years, n_exp = sel.shape
+    expansion_spend = np.zeros(n_years)
+    total = np.empty(n_years)
+    savings = np.empty(n_years)
+
+    for i in range(n_years):
+        for j in range(n_exp):
+            if sel[i, j] > 0.5:
+                expansion_spend[i] += exp_cost[j]
+
+        total[i] = expansion_spend[i] + fixed[i]
+        savings[i] = budget[i] - total[i]
+
+    return expansion_spend, total, savings
+
+
+# Without numba the loop runs as plain Python, it is only |Y| x |E| iterations
+if njit is not None:
+    compute_breakdown = njit(cache=True)(compute_breakdown)
+
+
+def export_results(model: pyo.ConcreteModel, business: pd.DataFrame) -> None:
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
 
-    plan_df = pd.DataFrame(plan_rows).sort_values("Year")
-    costs_df = pd.DataFrame(cost_rows).sort_values("Year")
+    years = sorted(list(model.Years))
+    exp_names = list(model.Expansions)
+
+    sel = np.fromiter(
+        (
+            (model.Select[y, e].value or 0.0) if (y, e) in model.SelectIdx else 0.0
+            for y in years
+            for e in exp_names
+        ),
+        dtype=np.float64,
+        count=len(years) * len(exp_names),
+    ).reshape(len(years), len(exp_names))
+    selected_mask = sel > 0.5
+
+    # Costs and budgets come from the model Params so scenario overrides are reported
+    def year_array(param: pyo.Param) -> np.ndarray:
+        values = param.extract_values()
+        return np.fromiter((values[y] for y in years), dtype=np.float64, count=len(years))
+
+    exp_cost_values = model.exp_cost.extract_values()
+    exp_cost_vec = np.fromiter((exp_cost_values[e] for e in exp_names), dtype=np.float64, count=len(exp_names))
+
+    wage = year_array(model.avg_wage)
+    labor = year_array(model.req_labor_hours) * wage
+    machine = year_array(model.req_machine_hours) * wage
+    operational = year_array(model.operational_cost)
+    raw_mat = year_array(model.raw_material_cost)
+    compliance = year_array(model.compliance_cost)
+    env = year_array(model.env_compliance_cost)
+    labor_law = year_array(model.labor_law_cost)
+    tech = year_array(model.tech_invest_cost)
+    budget = year_array(model.budget)
+
+    fixed = np.fromiter((pyo.value(annual_fixed_cost(model, y)) for y in years), dtype=np.float64, count=len(years))
+
+    expansion_spend, total, savings = compute_breakdown(sel, exp_cost_vec, fixed, budget)
+
+    costs_df = pd.DataFrame(
+        {
+            "Year": np.asarray(years, dtype=int),
+            "Expansion_Spend": expansion_spend,
+            "Operational_Cost": operational,
+            "Labor_Cost": labor,
+            "Machinery_Cost": machine,
+            "Raw_Material_Cost": raw_mat,
+            "Compliance_Cost": compliance,
+            "Environmental_Compliance_Cost": env,
+            "Labor_Law_Impact_Cost": labor_law,
+            "Technology_Investment_Cost": tech,
+            "Total_Cost": total,
+        }
+    )
 
-    plan_df.to_csv(RESULTS_DIR / "expansion_plan.csv", index=False)
-    costs_df.to_csv(RESULTS_DIR / "annual_cost_breakdown.csv", index=False)
+    selected = [
+        ", ".join(e for e, chosen in zip(exp_names, row) if chosen) or "None"
+        for row in selected_mask
+    ]
+
+    plan_df = pd.DataFrame(
+        {
+            "Year": costs_df["Year"],
+            "Selected_Expansions": selected,
+            "Annual_Budget": budget,
+            "Annual_Total_Cost": total,
+            "Annual_Budget_Savings": savings,
+        }
+    )
+
+    write_csv(plan_df, RESULTS_DIR / "expansion_plan.csv")
+    write_csv(costs_df, RESULTS_DIR / "annual_cost_breakdown.csv")
 
     total_revenue = float(business["Expected Total Revenue (USD)"].sum())
-    total_budget = float(business["Annual Budget (USD)"].sum())
-    total_cost = float(costs_df["Total_Cost"].sum())
-    total_savings = float(plan_df["Annual_Budget_Savings"].sum())
+    total_budget = float(budget.sum())
+    total_cost = float(total.sum())
+    total_savings = float(savings.sum())
 
     summary_text = "\n".join(
         [
@@ -145,10 +245,96 @@ def export_results(model: pyo.ConcreteModel, business: pd.DataFrame) -> None:
     print("Saved results to results folder")
 
 
-def main() -> None:
+def model_cache_key(business: pd.DataFrame, expansions: pd.DataFrame, initial_capacity: int) -> str:
+    # The model source is part of the key so edits to build_model invalidate old entries
+    model_source = Path(build_model.__code__.co_filename).read_bytes()
+    # hash_pandas_object only covers values, so column names and dtypes are added explicitly
+    payload = (
+        pd.util.hash_pandas_object(business, index=True).values.tobytes()
+        + pd.util.hash_pandas_object(expansions, index=True).values.tobytes()
+        + repr(list(business.columns)).encode()
+        + repr(list(expansions.columns)).encode()
+        + repr([str(t) for t in business.dtypes]).encode()
+        + repr([str(t) for t in expansions.dtypes]).encode()
+        + str(initial_capacity).encode()
+        + model_source
+        # Pickles are only readable by the library versions that wrote them
+        + pyomo_version.encode()
+        + cloudpickle.__version__.encode()
+    )
+    return hashlib.sha256(payload).hexdigest()
+
+
+def load_or_build_model(
+    business: pd.DataFrame,
+    expansions: pd.DataFrame,
+    initial_capacity: int = 40000,
+) -> pyo.ConcreteModel:
+    if cloudpickle is None:
+        return build_model(business=business, expansions=expansions, initial_capacity=initial_capacity)
+
+    cache_path = MODEL_CACHE_DIR / f"{model_cache_key(business, expansions, initial_capacity)}.pkl"
+    if cache_path.exists():
+        try:
+            with cache_path.open("rb") as f:
+                return cloudpickle.load(f)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # Unreadable entry, drop it and rebuild below
+            cache_path.unlink(missing_ok=True)
+
+    model = build_model(business=business, expansions=expansions, initial_capacity=initial_capacity)
+
+    # Write to a temp file and move it into place so an interrupted run never leaves a partial entry
+    MODEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=MODEL_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            cloudpickle.dump(model, f)
+        os.replace(tmp_name, cache_path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+    return model
+
+
+def build_once() -> tuple[pd.DataFrame, pd.DataFrame, pyo.ConcreteModel]:
     business, expansions = load_inputs()
-    model = build_model(business=business, expansions=expansions, initial_capacity=40000)
-    solve_model(model)
+    model = load_or_build_model(business=business, expansions=expansions, initial_capacity=40000)
+    return business, expansions, model
+
+
+def solve_with_overrides(
+    model: pyo.ConcreteModel,
+    overrides: Dict[str, Dict[object, float]],
+    solver: Any = None,
+) -> Any:
+    # Overrides map a mutable Param name to {index: new value}, the model itself is not rebuilt.
+    # Everything is validated first so a rejected override leaves the model untouched.
+    params = {}
+    for name in overrides:
+        param = model.component(name)
+        if param is None:
+            raise ValueError(f"Model has no parameter named {name}")
+        if not param.mutable:
+            raise ValueError(f"Parameter {name} is fixed at build time, rebuild the model instead")
+        params[name] = param
+
+    initial_capacity = model.initial_capacity.value
+    for y, value in overrides.get("demand", {}).items():
+        if y not in model.BindingYears and value > initial_capacity:
+            raise ValueError(f"Demand override makes year {y} binding, rebuild the model instead")
+
+    for name, values in overrides.items():
+        for idx, value in values.items():
+            params[name][idx] = value
+
+    return solve_model(model, solver=solver, warmstart=True)
+
+
+def main() -> None:
+    business, _, model = build_once()
+    solve_with_overrides(model, {})
     export_results(model, business)
 
 